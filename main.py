@@ -1,15 +1,18 @@
-import os, re, uuid, shutil
+import os, re, uuid, shutil, time, hashlib, hmac, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional, List
 
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from pydantic import BaseModel, Field
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 
 # ----------------------- Load Environment Variables -----------------------
@@ -17,6 +20,10 @@ load_dotenv()
 
 MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
 os.makedirs(MEDIA_ROOT, exist_ok=True)
+UPLOAD_CHUNK = 64 * 1024
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+# Whole request body; enforced while the body is received, before multipart spooling
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(50 * 1024 * 1024)))
 
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "vehiclereg")
@@ -27,22 +34,161 @@ JWT_EXPIRE_MIN = int(os.getenv("JWT_EXPIRE_MIN", "60"))
 
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "admin@vr.local")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
+# Precomputed bcrypt hash of the (SHA-256 pre-hashed) admin password, so workers skip the KDF at boot:
+#   python -c "import hashlib; from passlib.context import CryptContext; print(CryptContext(schemes=['bcrypt'], bcrypt__default_rounds=10).hash(hashlib.sha256(b'admin123').hexdigest()))"
+ADMIN_PASSWORD_HASH = os.getenv("ADMIN_PASSWORD_HASH")
 
 # ----------------------- Security & DB Setup -----------------------
-pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
-admin_hash = pwd_ctx.hash(ADMIN_PASSWORD)
+# Cost 10 (passlib defaults to 12) keeps a verify around a quarter of the time; acceptable for a
+# single admin account behind a bounded pool. Passwords are SHA-256 pre-hashed, so an
+# ADMIN_PASSWORD_HASH made from the raw password won't verify; regenerate it with the command above.
+BCRYPT_ROUNDS = 10
+pwd_ctx = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=BCRYPT_ROUNDS, deprecated="auto")
 
-client = MongoClient(MONGO_URL)
+
+def prep_password(pw: str) -> str:
+    """SHA-256 pre-hash so bcrypt never sees more than 72 bytes or a NUL byte"""
+    return hashlib.sha256(pw.encode()).hexdigest()
+
+
+admin_hash = ADMIN_PASSWORD_HASH or pwd_ctx.hash(prep_password(ADMIN_PASSWORD))
+# Verified against on unknown usernames so both login paths cost one bcrypt.
+# Precomputed (cost BCRYPT_ROUNDS) so workers don't run an extra KDF at boot.
+_dummy_hash = "$2b$10$0D8Kl/130.fToOFAgCM6s.g6znWnmfY8s7Jk24WinPDDJuvVx2lBq"
+
+
+
+def bcrypt_cost(h: str):
+    """Cost factor of a well-formed bcrypt hash, or None if it isn't one"""
+    try:
+        return pwd_ctx.handler("bcrypt").from_string(h).rounds
+    except (ValueError, TypeError):
+        return None
+
+
+# Both login paths must run bcrypt at the same cost, or the timing reveals the username
+_dummy_cost = bcrypt_cost(_dummy_hash)
+if _dummy_cost != BCRYPT_ROUNDS:
+    raise RuntimeError("_dummy_hash must be regenerated when BCRYPT_ROUNDS changes")
+if bcrypt_cost(admin_hash) != _dummy_cost:
+    raise RuntimeError(f"ADMIN_PASSWORD_HASH must be a bcrypt hash with cost {_dummy_cost}; regenerate it")
+# Dedicated, bounded pool for bcrypt so login storms can't starve the default threadpool
+BCRYPT_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bcrypt")
+
+MONGO_OPTS = dict(
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL", "50")),
+    serverSelectionTimeoutMS=2000,
+)
+
+# Sync client for the threadpool endpoints, pymongo's async client for the async ones.
+# Only the sync pool (which serves most traffic) keeps warm idle connections.
+client = MongoClient(MONGO_URL, minPoolSize=int(os.getenv("MONGO_MIN_POOL", "10")), **MONGO_OPTS)
 db = client[DB_NAME]
 cars = db["cars"]
+
+aclient = AsyncMongoClient(MONGO_URL, **MONGO_OPTS)
+acars = aclient[DB_NAME]["cars"]
 cars.create_index("reg", unique=True)
 cars.create_index([("brand", 1), ("model", 1)])
 
+# Lowercased copies of brand/model, so case-insensitive filters are plain index lookups
+cars.create_index([("brand_lc", 1), ("model_lc", 1)])
+cars.create_index("model_lc")
+cars.update_many(
+    {"brand_lc": {"$exists": False}},
+    [{"$set": {
+        "brand_lc": {"$toLower": {"$trim": {"input": "$brand"}}},
+        "model_lc": {"$toLower": {"$trim": {"input": "$model"}}},
+    }}],
+)
+# Internal fields never returned to clients
+HIDDEN_FIELDS = {"_id": 0, "brand_lc": 0, "model_lc": 0}
+# Equality on is_sold, then range on price (the common listing filter)
+cars.create_index([("is_sold", 1), ("price", 1)])
+
 
 # ----------------------- Helper Functions -----------------------
+# Uppercase letters and digits (at least one of each), 6-12 chars once normalized
+PLATE_RE = re.compile(r"(?=.*\d)(?=.*[A-Z])[A-Z0-9]{6,12}")
+# A normalized reg is also a media folder name: no empty/dot-only names or path separators
+REG_RE = re.compile(r"[A-Z0-9][A-Z0-9_-]*")
+
+
 def norm_reg(reg: str) -> str:
     """Normalize registration number"""
-    return re.sub(r"\s+", "", reg or "").upper()
+    return "".join((reg or "").split()).upper()
+
+
+def norm_name(name: str) -> str:
+    """Normalize brand/model for the *_lc lookup fields"""
+    return (name or "").strip().lower()
+
+
+# Short-lived cache of get_car lookups keyed by normalized reg; writes invalidate it.
+# _CAR_GEN counts invalidations per reg so a read that raced a write isn't cached; when it
+# outgrows _CAR_CACHE_MAX it is cleared and _car_epoch bumped, so in-flight reads skip caching.
+_CAR_CACHE: dict = {}
+_CAR_GEN: dict = {}
+_car_epoch = 0
+_CAR_CACHE_MAX = 2048
+_CAR_CACHE_TTL = 30
+_car_lock = threading.Lock()
+
+
+def cached_car(nreg: str):
+    """Return the cached doc for a reg, or None if missing/expired"""
+    with _car_lock:
+        hit = _CAR_CACHE.get(nreg)
+    if hit and hit[1] > time.monotonic():
+        return hit[0]
+    return None
+
+
+def car_generation(nreg: str) -> tuple:
+    """Current invalidation marker for a reg; read it before querying Mongo"""
+    with _car_lock:
+        return _car_epoch, _CAR_GEN.get(nreg, 0)
+
+
+def cache_car(nreg: str, doc: dict, gen: tuple):
+    """Store a doc for _CAR_CACHE_TTL seconds unless the reg was invalidated since gen"""
+    with _car_lock:
+        if (_car_epoch, _CAR_GEN.get(nreg, 0)) != gen:
+            return
+        _CAR_CACHE.pop(nreg, None)
+        if len(_CAR_CACHE) >= _CAR_CACHE_MAX:
+            _CAR_CACHE.pop(next(iter(_CAR_CACHE)))
+        _CAR_CACHE[nreg] = (doc, time.monotonic() + _CAR_CACHE_TTL)
+
+
+def invalidate_car(nreg: str):
+    """Drop a reg from the cache after a write that matched a document"""
+    global _car_epoch
+    with _car_lock:
+        if nreg not in _CAR_GEN and len(_CAR_GEN) >= _CAR_CACHE_MAX:
+            _CAR_GEN.clear()
+            _car_epoch += 1
+        _CAR_GEN[nreg] = _CAR_GEN.get(nreg, 0) + 1
+        _CAR_CACHE.pop(nreg, None)
+
+
+def save_upload(src, path: str):
+    """Write an uploaded file to disk (blocking; run in an executor)"""
+    with open(path, "wb") as w:
+        shutil.copyfileobj(src, w, UPLOAD_CHUNK)
+
+
+def remove_uploads(out_dir: str, names: List[str]):
+    """Delete the given files from out_dir, and out_dir itself if left empty"""
+    for fname in names:
+        try:
+            os.remove(os.path.join(out_dir, fname))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(out_dir)
+    except OSError:
+        pass
 
 
 def create_token(payload: dict, minutes=JWT_EXPIRE_MIN):
@@ -52,13 +198,68 @@ def create_token(payload: dict, minutes=JWT_EXPIRE_MIN):
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALG)
 
 
+# Verified token payloads keyed by a digest of the raw token (only successes are cached)
+_TOKEN_CACHE: dict = {}
+_TOKEN_CACHE_MAX = 1024
+_token_lock = threading.Lock()
+
+
 def parse_token(token: str):
-    """Decode JWT token"""
+    """Decode JWT token (cached until the token's own expiry)"""
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    with _token_lock:
+        hit = _TOKEN_CACHE.get(key)
+    if hit and hit[1] > now:
+        return hit[0]
+
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
     except JWTError:
         raise HTTPException(401, "Invalid or expired token")
 
+    exp = data.get("exp")
+    if isinstance(exp, (int, float)) and exp > now:
+        with _token_lock:
+            if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+                # Drop expired entries first, then the oldest if still full
+                for k in [k for k, v in _TOKEN_CACHE.items() if v[1] <= now]:
+                    del _TOKEN_CACHE[k]
+                if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+                    _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)))
+            _TOKEN_CACHE[key] = (data, exp)
+    return data
+
+
+class BodySizeLimitMiddleware:
+    """Reject request bodies over max_bytes, by Content-Length or while streaming"""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(413, "Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 
 # ----------------------- Dependencies -----------------------
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -91,6 +292,18 @@ class VehicleOut(VehicleIn):
     is_sold: bool = False
 
 
+class VehicleUpdate(BaseModel):
+    brand: Optional[str] = None
+    model: Optional[str] = None
+    year: Optional[int] = None
+    price: Optional[float] = None
+    kms: Optional[int] = Field(default=None, ge=0)
+    fuel: Optional[str] = None
+    transmission: Optional[str] = None
+    owner: Optional[str] = None
+    description: Optional[str] = None
+
+
 class CarQuery(BaseModel):
     q: Optional[str] = None
     brand: Optional[str] = None
@@ -101,6 +314,8 @@ class CarQuery(BaseModel):
 # ----------------------- FastAPI App -----------------------
 app = FastAPI(title="Vehicle Registry API")
 
+# Added before CORS so 413 responses still carry CORS headers
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_BODY_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -121,42 +336,61 @@ def root():
 
 # ----------------------- Auth -----------------------
 @app.post("/auth/login")
-def login(form: OAuth2PasswordRequestForm = Depends()):
+async def login(form: OAuth2PasswordRequestForm = Depends()):
     """Simple Admin Login"""
-    if form.username.lower() != ADMIN_EMAIL.lower():
-        raise HTTPException(401, "Invalid credentials")
-    if not pwd_ctx.verify(form.password, admin_hash):
+    user_ok = hmac.compare_digest(form.username.lower().encode(), ADMIN_EMAIL.lower().encode())
+    loop = asyncio.get_running_loop()
+    pw_ok = await loop.run_in_executor(
+        BCRYPT_POOL, pwd_ctx.verify, prep_password(form.password), admin_hash if user_ok else _dummy_hash
+    )
+    if not (user_ok and pw_ok):
         raise HTTPException(401, "Invalid credentials")
     token = create_token({"sub": ADMIN_EMAIL, "role": "admin"})
     return {"access_token": token, "token_type": "bearer"}
 
 
 # ----------------------- Cars: List -----------------------
-@app.get("/cars", response_model=List[VehicleOut])
+@app.get("/cars", response_model=None)
 def list_cars(
     q: Optional[str] = None,
     brand: Optional[str] = None,
     max_price: Optional[float] = None,
     is_sold: Optional[bool] = None,
-    limit: int = Query(100, le=500),
+    limit: int = Query(100, ge=1, le=500),
 ):
     """Fetch list of cars"""
     query = {}
-    if q:
-        query["$or"] = [
-            {"brand": {"$regex": q, "$options": "i"}},
-            {"model": {"$regex": q, "$options": "i"}},
-            {"reg": {"$regex": norm_reg(q), "$options": "i"}},
-        ]
     if brand:
-        query["brand"] = {"$regex": brand, "$options": "i"}
+        query["brand_lc"] = norm_name(brand)
     if max_price is not None:
         query["price"] = {"$lte": max_price}
     if is_sold is not None:
         query["is_sold"] = is_sold
 
-    docs = list(cars.find(query, {"_id": 0}).limit(limit))
-    return docs or []
+    # Stored docs were validated on write, so they're returned without re-validation.
+    # The list view doesn't show descriptions; fetch the whole page in one batch.
+    def fetch(extra: dict):
+        cursor = cars.find({**query, **extra}, {**HIDDEN_FIELDS, "description": 0})
+        return list(cursor.limit(limit).batch_size(limit))
+
+    if not q:
+        return fetch({})
+
+    nq = norm_reg(q)
+    if q == q.upper() and PLATE_RE.fullmatch(nq):
+        # Looks like a full registration number: try a single hit on the unique index first
+        docs = fetch({"reg": nq})
+        if docs:
+            return docs
+
+    # Anchored, case-sensitive prefixes on normalized fields: every branch is
+    # index-backed, so the $or as a whole avoids a collection scan
+    prefix = "^" + re.escape(norm_name(q))
+    return fetch({"$or": [
+        {"brand_lc": {"$regex": prefix}},
+        {"model_lc": {"$regex": prefix}},
+        {"reg": {"$regex": "^" + re.escape(nq)}},
+    ]})
 
 
 # ----------------------- Cars: Create -----------------------
@@ -176,26 +410,25 @@ async def create_car(
 ):
     """Admin can create a new car entry"""
     nreg = norm_reg(reg)
-    if cars.find_one({"reg": nreg}):
-        raise HTTPException(409, "Registration already exists")
+    if not REG_RE.fullmatch(nreg):
+        raise HTTPException(400, "Invalid registration number")
 
-    # Save uploaded images
-    img_urls: List[str] = []
+    # Pick image file names up front; files are only written once the insert succeeds
     out_dir = os.path.join(MEDIA_ROOT, nreg)
-    os.makedirs(out_dir, exist_ok=True)
-
+    img_names: List[str] = []
     for idx, f in enumerate(images):
+        if f.size is not None and f.size > MAX_IMAGE_BYTES:
+            raise HTTPException(413, "Image too large")
         ext = os.path.splitext(f.filename)[1] or ".jpg"
-        fname = f"{idx:03d}_{uuid.uuid4().hex}{ext}"
-        path = os.path.join(out_dir, fname)
-        with open(path, "wb") as w:
-            shutil.copyfileobj(f.file, w)
-        img_urls.append(f"/media/{nreg}/{fname}")
+        img_names.append(f"{idx:03d}_{uuid.uuid4().hex}{ext}")
+    img_urls = [f"/media/{nreg}/{fname}" for fname in img_names]
 
     doc = {
         "reg": nreg,
         "brand": brand,
         "model": model,
+        "brand_lc": norm_name(brand),
+        "model_lc": norm_name(model),
         "year": year,
         "price": float(price),
         "kms": int(kms),
@@ -207,17 +440,46 @@ async def create_car(
         "is_sold": False,
     }
 
-    cars.insert_one(doc)
+    # The unique index on reg rejects duplicates atomically
+    try:
+        await acars.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(409, "Registration already exists")
+    invalidate_car(nreg)
+
+    # Save uploaded images
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        # Let every write finish before cleaning up, so none races the rollback
+        results = await asyncio.gather(*[
+            loop.run_in_executor(None, save_upload, f.file, os.path.join(out_dir, fname))
+            for f, fname in zip(images, img_names)
+        ], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+    except Exception:
+        await acars.delete_one({"reg": nreg})
+        invalidate_car(nreg)
+        remove_uploads(out_dir, img_names)
+        raise
+
     return doc
 
 
 # ----------------------- Cars: Get by Reg -----------------------
-@app.get("/cars/{reg}", response_model=VehicleOut)
+@app.get("/cars/{reg}", response_model=None)
 def get_car(reg: str):
     """Get car details by registration number"""
-    doc = cars.find_one({"reg": norm_reg(reg)}, {"_id": 0})
-    if not doc:
-        raise HTTPException(404, "Vehicle not found")
+    nreg = norm_reg(reg)
+    doc = cached_car(nreg)
+    if doc is None:
+        gen = car_generation(nreg)
+        doc = cars.find_one({"reg": nreg}, HIDDEN_FIELDS)
+        if not doc:
+            raise HTTPException(404, "Vehicle not found")
+        cache_car(nreg, doc, gen)
     return doc
 
 
@@ -229,6 +491,7 @@ def delete_car(reg: str):
     res = cars.find_one_and_delete({"reg": nreg})
     if not res:
         raise HTTPException(404, "Vehicle not found")
+    invalidate_car(nreg)
 
     folder = os.path.join(MEDIA_ROOT, nreg)
     if os.path.isdir(folder):
@@ -242,49 +505,32 @@ def delete_car(reg: str):
 def mark_car_sold(reg: str):
     """Mark a car as sold"""
     nreg = norm_reg(reg)
-    res = cars.find_one({"reg": nreg})
+    res = cars.find_one_and_update({"reg": nreg}, {"$set": {"is_sold": True}}, projection={"_id": 0})
     if not res:
         raise HTTPException(404, "Vehicle not found")
+    invalidate_car(nreg)
 
-    cars.update_one({"reg": nreg}, {"$set": {"is_sold": True}})
     return {"ok": True, "reg": nreg, "status": "sold"}
 
 @app.patch("/cars/{reg}", dependencies=[Depends(admin_required)], response_model=VehicleOut)
-async def update_car(
-    reg: str,
-    brand: Optional[str] = Form(None),
-    model: Optional[str] = Form(None),
-    year: Optional[int] = Form(None),
-    price: Optional[float] = Form(None),
-    kms: Optional[int] = Form(None),
-    fuel: Optional[str] = Form(None),
-    transmission: Optional[str] = Form(None),
-    owner: Optional[str] = Form(None),
-    description: Optional[str] = Form(None),
-):
+async def update_car(reg: str, body: VehicleUpdate):
+    """Partially update a car entry (JSON body; only provided fields change)"""
     nreg = norm_reg(reg)
-    doc = cars.find_one({"reg": nreg})
-    if not doc:
-        raise HTTPException(404, "Vehicle not found")
-
-    update_data = {}
-    for k, v in dict(
-        brand=brand,
-        model=model,
-        year=year,
-        price=price,
-        kms=kms,
-        fuel=fuel,
-        transmission=transmission,
-        owner=owner,
-        description=description,
-    ).items():
-        if v is not None:
-            update_data[k] = v
+    update_data = body.model_dump(exclude_unset=True, exclude_none=True)
 
     if not update_data:
         raise HTTPException(400, "No fields to update")
-
-    cars.update_one({"reg": nreg}, {"$set": update_data})
-    final_doc = cars.find_one({"reg": nreg}, {"_id": 0})
+    for field in ("brand", "model"):
+        if field in update_data:
+            update_data[f"{field}_lc"] = norm_name(update_data[field])
+
+    final_doc = await acars.find_one_and_update(
+        {"reg": nreg},
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not final_doc:
+        raise HTTPException(404, "Vehicle not found")
+    invalidate_car(nreg)
     return final_doc